@@ -1,72 +1,190 @@
-from datasketch import MinHash, MinHashLSH
+from datasketch import MinHash, LeanMinHash, MinHashLSH
 from tqdm import tqdm
 from collections import defaultdict, Counter
+import math
+from concurrent.futures import ProcessPoolExecutor
+from src.utils import parse_credential, iter_plaintext_records, build_postings, gather_postings, most_common_row
 
 similar_threshold = 0.8
 
-def calculate_successful_identification(frequent_subsequences, plaintext_series):
-    success = 0
-    lsh = MinHashLSH(threshold=similar_threshold, num_perm=128)
-    minhashes = []
-
-    for key, row in tqdm(enumerate(frequent_subsequences), total=len(frequent_subsequences), desc='Loading'):
-        m = MinHash(num_perm=128)
-        for seq in row:
-            m.update(seq.encode('utf8'))
-        lsh.insert(key, m)
-
-    for key, query_list in tqdm(enumerate(plaintext_series), total=len(plaintext_series), desc='Calculating successful identification:'):
-        m2 = MinHash(num_perm=128)
-        for q in query_list:
-            m2.update(q.encode('utf8'))
-        sim_set = lsh.query(m2)
-        if len(sim_set) >= 1:
-            success += 1
-
-    return success
-
-
-def calculate_effective_identification(frequent_subsequences, plaintext_series):
-    effectiveness = 0
-    lsh = MinHashLSH(threshold=similar_threshold, num_perm=128)
-
-    for key, subseq in tqdm(enumerate(plaintext_series), total=len(plaintext_series), desc='Loading'):
-        m = MinHash(num_perm=128)
-        for seq in subseq:
-            m.update(seq.encode('utf8'))
-        lsh.insert(key, m)
-    
-    for key, query_list in tqdm(enumerate(frequent_subsequences), total=len(frequent_subsequences), desc='Calculating effective identification:'):
-        m2 = MinHash(num_perm=128)
-        for q in query_list:
-            m2.update(q.encode('utf8'))
-        sim_set = lsh.query(m2)
-        if len(sim_set) >= 1:
-            effectiveness += 1
-
-    return effectiveness
+def _prefix_size(size, threshold):
+    # Any set with Jaccard >= threshold must share a token within this many leading tokens.
+    return size - math.ceil(threshold * size - 1e-9) + 1
+
+def _build_similarity_index(rows, threshold=similar_threshold):
+    # Tokens are ordered by ascending frequency in the indexed rows and only the prefix of each
+    # set goes into the inverted index, with each token's position in its set.
+    freq = Counter()
+    for row in rows:
+        freq.update(set(row))
+
+    sets = []
+    index = defaultdict(list)
+    for key, row in enumerate(rows):
+        tokens = sorted(set(row), key=lambda t: (freq.get(t, 0), t))
+        sets.append(frozenset(tokens))
+        for pos, t in enumerate(tokens[:_prefix_size(len(tokens), threshold)]):
+            index[t].append((key, pos))
+    return freq, sets, index, threshold
+
+def _probe_similarity_index(similarity_index, rows, start=0):
+    # Probe with each row's own prefix, prune candidates by size and by position (AllPairs) and
+    # verify the exact Jaccard. Both sets are in the same token order, so every shared token comes at
+    # or after the first one seen, which bounds the overlap by the tokens left in the shorter tail.
+    # The metrics only ask whether a row has any similar partner, so once the probing row is
+    # matched, candidates that already matched an earlier row are not verified again.
+    freq, sets, index, threshold = similarity_index
+    pairs = []
+    matched = set()
+    for key, row in enumerate(rows, start):
+        tokens = sorted(set(row), key=lambda t: (freq.get(t, 0), t))
+        size = len(tokens)
+        if size == 0:
+            continue
+        query = frozenset(tokens)
+        low, high = threshold * size, size / threshold
+        seen = set()
+        candidates = []
+        for pos, t in enumerate(tokens[:_prefix_size(size, threshold)]):
+            for idx, other_pos in index.get(t, ()):
+                if idx in seen:
+                    continue
+                seen.add(idx)
+                other_size = len(sets[idx])
+                if not low <= other_size <= high:
+                    continue
+                required = math.ceil(threshold / (1 + threshold) * (size + other_size) - 1e-9)
+                if min(size - pos, other_size - other_pos) >= required:
+                    candidates.append(idx)
+        found = False
+        for idx in candidates:
+            if found and idx in matched:
+                continue
+            other = sets[idx]
+            overlap = len(query & other)
+            if overlap / (size + len(other) - overlap) >= threshold:
+                pairs.append((key, idx))
+                matched.add(idx)
+                found = True
+    return pairs
+
+_worker_index = None
+
+def _init_probe_worker(index):
+    global _worker_index
+    _worker_index = index
+
+def _probe_chunk(task):
+    probe, start, rows = task
+    return probe(_worker_index, rows, start)
+
+def _run_probes(probe, index, rows, workers=1, desc=None):
+    """
+    Run probe(index, rows, start) over all rows, optionally sharded across worker processes.
+
+    Each worker receives the read-only index once through the pool initializer and then streams
+    its chunks of rows; the per-chunk results are concatenated in order.
+    """
+    if workers <= 1 or len(rows) < 2:
+        return probe(index, tqdm(rows, desc=desc, mininterval=5), 0)
+    size = math.ceil(len(rows) / (workers * 4))
+    tasks = [(probe, start, rows[start:start + size]) for start in range(0, len(rows), size)]
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_probe_worker, initargs=(index,)) as executor:
+        for part in tqdm(executor.map(_probe_chunk, tasks), total=len(tasks), desc=desc):
+            results.extend(part)
+    return results
+
+def encode_series(series):
+    """
+    Encode the tokens of every row to UTF-8 bytes once.
+
+    Both identification metrics accept the encoded rows directly, so callers evaluating the same
+    series repeatedly can pay for the encoding once instead of on every call.
+    """
+    return [[token.encode('utf8') for token in row] for row in series]
+
+def _lean_minhashes(rows, num_perm=128):
+    # MinHash.generator shares the permutations and hashes each row with one numpy batch update.
+    encoded = (row if not row or isinstance(row[0], bytes) else [seq.encode('utf8') for seq in row] for row in rows)
+    for m in MinHash.generator(encoded, num_perm=num_perm):
+        yield LeanMinHash(m)
+
+def _build_lsh(rows, threshold=similar_threshold):
+    lsh = MinHashLSH(threshold=threshold, num_perm=128)
+    # Keys are row positions and therefore unique, so the duplication check can be skipped.
+    with lsh.insertion_session() as session:
+        for key, m in tqdm(enumerate(_lean_minhashes(rows)), total=len(rows), desc='Loading', mininterval=5):
+            session.insert(key, m, check_duplication=False)
+    return lsh
+
+def _probe_lsh(lsh, rows, start=0):
+    return [(key, idx) for key, m in enumerate(_lean_minhashes(rows), start) for idx in lsh.query(m)]
+
+def _similar_pairs(left, right, threshold=similar_threshold, method='exact', workers=1, desc=None):
+    """
+    Similarity join between two collections of token lists.
+
+    The smaller collection is indexed once and every row of the other one probes it:
+      - 'exact': prefix-filtered inverted index with exact Jaccard verification, no MinHash permutations.
+      - 'minhash': MinHashLSH candidates (approximate); bucket collisions are symmetric, so one
+        direction of probing yields the pairs for both.
+
+    Returns:
+        list: (i, j) pairs such that set(left[i]) and set(right[j]) are similar at the threshold.
+              With 'exact', only enough pairs are kept to cover every row that has a similar
+              partner on the other side.
+    """
+    swap = len(right) < len(left)
+    indexed, probes = (right, left) if swap else (left, right)
+    if method == 'exact':
+        index, probe = _build_similarity_index(indexed, threshold), _probe_similarity_index
+    elif method == 'minhash':
+        index, probe = _build_lsh(indexed, threshold), _probe_lsh
+    else:
+        raise ValueError(f'Unsupported similarity method: {method}')
+    pairs = _run_probes(probe, index, probes, workers, desc)
+    return pairs if swap else [(i, j) for j, i in pairs]
+
+def calculate_identification_metrics(frequent_subsequences, plaintext_series, method='exact', workers=1):
+    """
+    Compute the successful and effective identification counts from a single similarity join.
+
+    Args:
+        frequent_subsequences (list): Identified query sequences (e.g. RangeCombiningAttack.get_result()).
+        plaintext_series (list): Ground-truth query series of PM users.
+        method (str): 'exact' or 'minhash', see `_similar_pairs`.
+        workers (int): Number of processes used for probing.
+
+    Returns:
+        tuple: (success, effectiveness), i.e. the number of plaintext series matched by some
+               identified sequence and the number of identified sequences matching some series.
+    """
+    pairs = _similar_pairs(frequent_subsequences, plaintext_series, method=method, workers=workers, desc='Calculating identification:')
+    success = len({j for _, j in pairs})
+    effectiveness = len({i for i, _ in pairs})
+    return success, effectiveness
+
+def calculate_successful_identification(frequent_subsequences, plaintext_series, method='exact', workers=1):
+    return calculate_identification_metrics(frequent_subsequences, plaintext_series, method, workers)[0]
+
+
+def calculate_effective_identification(frequent_subsequences, plaintext_series, method='exact', workers=1):
+    return calculate_identification_metrics(frequent_subsequences, plaintext_series, method, workers)[1]
 
 def calculate_connected_popular_rate(connected_result, query_type):
     total_p = 0
     popular_p = 0
-    top_password = set()
     # You need to set a file for popular passwords
     with open('tgaux_en_toppsw.txt', 'r', encoding='utf-8') as f:
-        for line in f:
-            pwd, pro = line.split('\t')
-            top_password.add(pwd)
+        top_password = frozenset(line.split('\t', 1)[0] for line in f)
 
     for p in connected_result:
         total_p += len(p[0])
         if query_type == 'pass':
-            for pw in p[0]:
-                if pw in top_password:
-                    popular_p += 1
+            popular_p += sum(1 for pw in p[0] if pw in top_password)
         elif query_type == 'cred':
-            for c in p[0]:
-                cre = eval(c)
-                if cre[1] in top_password:
-                    popular_p += 1
+            popular_p += sum(1 for c in p[0] if parse_credential(c)[1] in top_password)
 
     if total_p == 0:
         return 0, 0, 0
@@ -76,76 +194,39 @@ def calculate_connected_popular_rate(connected_result, query_type):
 def calculate_connected_success_rate(connected_result, query_type, origin_path, overlap):
     success = 0
     
-    index = defaultdict(set)
-    connected_list = []
-
-    for key, row in tqdm(enumerate(connected_result), total=len(connected_result), desc='Loading'):
-        candidate_list = row[0] + row[2]
-        connected_list.append(candidate_list)
-        for matches in candidate_list:
-            index[matches].add(key)
+    index = build_postings([row[0] + row[2] for row in connected_result], desc='Loading')
 
     cnt = 0
-    with open(origin_path, 'r', encoding='utf8') as f:
-        for line in f:
-            posp, _, unmatches_list, plaintext = eval(line)
-            if len(plaintext) < 10 or _ < 2 or len(plaintext) > 20:
-                continue
-            cnt += 1
-            counter = Counter()
-            for unmatches in set(plaintext):
-                for idx in index.get(unmatches, []):
-                    counter[idx] += 1
-            if not counter:
-                continue
-            best_idx = max(counter, key=lambda x: counter[x])
-            if counter[best_idx] >= overlap:
-                success += 1
+    for posp, _, unmatches_list, plaintext in iter_plaintext_records(origin_path):
+        if len(plaintext) < 10 or _ < 2 or len(plaintext) > 20:
+            continue
+        cnt += 1
+        hits = gather_postings(index, plaintext)
+        if hits is None:
+            continue
+        best_idx, best_overlap = most_common_row(hits)
+        if best_overlap >= overlap:
+            success += 1
     print(cnt)
     return success
 
-def calculate_ideal_connected(leak_set_path, query_set_path, origin_path, query_type, overlap):
-    leak_table = {}
-    leak_set = set()
-
-    index = defaultdict(set)
-    connected_list = []
-    pos = 0
-    with open(leak_set_path, 'r') as f:
-        for line in tqdm(f):
-            credentials = line.split('\t')[:-1]
-            if len(credentials) <= 10:
-                continue
-            connected_list.append(credentials)
-            for c in credentials:
-                try:
-                    username, password = eval(c)
-                except SyntaxError:
-                    username, password = eval("['"+c)
-                if query_type == "pass":
-                    index[password].add(pos)
-                elif query_type == "user":
-                    index[username].add(pos)
-                elif query_type == "cred":
-                    index[c].add(pos)
-            pos += 1
-    
+def calculate_ideal_connected(leaked_index, origin_path, overlap):
+    """
+    Count the origin series that could be connected to some leaked row if every plaintext were known.
+
+    `leaked_index` is the plaintext index of the precomputed leaked dataset, as returned by
+    `CredentialConnectingAttack.get_plaintext_index()`.
+    """
     success = 0
-    with open(origin_path, 'r', encoding='utf8') as f:
-        for line in tqdm(f):
-            posp, _, unmatches_list, plaintext = eval(line)
-            if len(plaintext) < 10 or _ < 2 or len(plaintext) > 20:
-                continue
-            counter = Counter()
-            for plain in set(plaintext):
-                for idx in index.get(plain, []):
-                    counter[idx] += 1
-            if not counter:
-                continue
-            best_idx = max(counter, key=lambda x: counter[x])
-            if counter[best_idx] >= overlap:
-                success += 1
+    for posp, _, unmatches_list, plaintext in tqdm(iter_plaintext_records(origin_path), mininterval=5):
+        if len(plaintext) < 10 or _ < 2 or len(plaintext) > 20:
+            continue
+        hits = gather_postings(leaked_index, plaintext)
+        if hits is None:
+            continue
+        best_idx, best_overlap = most_common_row(hits)
+        if best_overlap >= overlap:
+            success += 1
 
     return success
 
-    
\ No newline at end of file
@@ -2,13 +2,15 @@
 
 import os
 import sys
+from ast import literal_eval
+from itertools import islice
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from src.query_simulation import split_data, generate_queries
 from src.attacks.l_identifying import LIdentifyingAttack
 from src.attacks.range_combining import RangeCombiningAttack
 from src.attacks.credential_connecting import CredentialConnectingAttack
 from src.attacks.credential_guessing import CredentialGuessing
-from evaluation.metrics import calculate_successful_identification, calculate_effective_identification, calculate_connected_popular_rate, calculate_connected_success_rate, calculate_ideal_connected 
+from evaluation.metrics import encode_series, calculate_identification_metrics, calculate_connected_popular_rate, calculate_connected_success_rate, calculate_ideal_connected 
 from tqdm import tqdm
 from src.utils import load_plaintext_series, load_config, load_leaked_dataset
 
@@ -18,7 +20,7 @@ def main():
     
     # # === Step 1: Data Splitting ===
     split_cfg = config["split"]
-    split_data(**split_cfg)
+    split_data(**split_cfg, workers=os.cpu_count())
     
     # # === Step 2: Query Generation ===
     qgen_cfg = config["query_generation"]
@@ -47,22 +49,30 @@ def main():
         l_identifying_attack_list.append(LIdentifyingAttack(length_l=qlen, prune_threshold=min_threshold, prune_interval=5000000))
         
     plaintext_series, total_num = load_plaintext_series(os.path.join(config["queries_output_dir"], f"{qtype}_plain_queries_len{lengths}.txt"), l_idf_cfg["length_low"], l_idf_cfg["length_high"]-1, 10)
+    # Only the MinHash join hashes token bytes, so the series are pre-encoded for it alone.
+    similarity_method = l_idf_cfg.get("similarity_method", "exact")
+    if similarity_method == 'minhash':
+        plaintext_series = encode_series(plaintext_series)
     
     y_success_graph = [0]
     y_effective_graph = [0]
     with open(os.path.join(config["queries_output_dir"], f"{qtype}_queries_len{lengths}.txt"), 'r') as f:
         cnt = 0
-        for line in f:
-            cnt += 1
+        # Queries are fed in batches that evenly divide the 20M-query evaluation interval.
+        while True:
+            batch = [line.strip() for line in islice(f, 1000000)]
+            if not batch:
+                break
+            cnt += len(batch)
             for id_attack in l_identifying_attack_list:
-                id_attack.process(line.strip()) 
+                id_attack.process_batch(batch)
             if cnt % 20000000 == 0:
                 print("Day", int(cnt/1000000))
                 for id_attack in l_identifying_attack_list:
                     rc.load_l_identifying_result(id_attack.get_result(), query_length=id_attack._l)
                 identified_results = rc.get_result()
-                success_rate = calculate_successful_identification(identified_results, plaintext_series)
-                effective_rate = calculate_effective_identification(identified_results, plaintext_series)
+                identified_series = encode_series(identified_results) if similarity_method == 'minhash' else identified_results
+                success_rate, effective_rate = calculate_identification_metrics(identified_series, plaintext_series, method=similarity_method, workers=os.cpu_count())
                 y_success_graph.append(success_rate / total_num)
                 y_effective_graph.append(effective_rate / len(identified_results))
                 print('Identified numbers:{};Total numbers:{}; Successful identified:{}; Successful rate:{:.2%}; Effective identified:{}; Effective rate: {:.2%}'.format(len(identified_results), total_num, success_rate, success_rate/total_num, effective_rate, effective_rate/len(identified_results)))
@@ -85,15 +95,15 @@ def main():
 
     with open(os.path.join(config["identification_output_dir"], f"{qtype}_sequences_len{lengths}_min{min_threshold}_{length_low}-{length_high-1}.txt"), 'r') as f:
         for line in tqdm(f, desc="Loading identified queries"):
-            identified_queries.append(eval(line))
+            identified_queries.append(literal_eval(line))
 
     connector = CredentialConnectingAttack(split_cfg["output_leak_path"])
-    connector.pre_compute(qtype, lengths)
+    connector.pre_compute(qtype, lengths, cache_dir=recovery_config.get("cache_dir"))
     connected_result = connector.run(identified_queries, connected_overlap)
 
     total_p, popular_p, popular_rate = calculate_connected_popular_rate(connected_result, qtype)
     success = calculate_connected_success_rate(connected_result, qtype, os.path.join(config["queries_output_dir"], f"{qtype}_plain_queries_len{lengths}.txt"), connected_overlap)
-    ideal_succss = calculate_ideal_connected(split_cfg["output_leak_path"], split_cfg["output_source_path"], os.path.join(config["queries_output_dir"], f"{qtype}_plain_queries_len{lengths}.txt"), qtype, connected_overlap)
+    ideal_succss = calculate_ideal_connected(connector.get_plaintext_index(), os.path.join(config["queries_output_dir"], f"{qtype}_plain_queries_len{lengths}.txt"), connected_overlap)
     if ideal_succss == 0:
         success_rate = 0
     else:
@@ -117,7 +127,9 @@ def main():
         connected_result_path=os.path.join(config["recovery_output_dir"], f"{qtype}_connected_queries_len{lengths}_min{connected_overlap}.txt"),
         origin_path=os.path.join(config["queries_output_dir"], f"{qtype}_plain_queries_len{lengths}.txt"),
         output_path=os.path.join(config["output_guess_result"], f"{qtype}_final_results_len{lengths}_connect.txt"),
-        leak_set=leak_set
+        leak_set=leak_set,
+        workers=os.cpu_count(),
+        cache_dir=recovery_config.get("cache_dir")
     )
 
 
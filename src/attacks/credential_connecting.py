@@ -10,7 +10,40 @@ and which do not, effectively "connecting" guessed passwords to real user accoun
 
 from tqdm import tqdm
 import hashlib
-from collections import defaultdict, Counter
+import os
+import numpy as np
+from src.utils import parse_credential, build_postings, build_id_postings, most_common_row, cache_key, save_array_cache, load_array_cache
+
+def _multiset_diff(a, b) -> list:
+    """Elements of `a` left after removing one occurrence per element of `b` (same as Counter subtraction)."""
+    remaining = {}
+    for x in a:
+        remaining[x] = remaining.get(x, 0) + 1
+    for x in b:
+        count = remaining.get(x, 0)
+        if count == 1:
+            del remaining[x]
+        elif count:
+            remaining[x] = count - 1
+    return [x for x, count in remaining.items() for _ in range(count)]
+
+class _CSRRows:
+    """Read-only list-of-rows view over a flat array, where row i is values[offsets[i]:offsets[i+1]]."""
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        values, offsets = self.values, self.offsets
+        for i in range(len(offsets) - 1):
+            yield values[offsets[i]:offsets[i + 1]]
 
 class CredentialConnectingAttack:
     """
@@ -39,15 +72,24 @@ class CredentialConnectingAttack:
             OSError: If the file cannot be accessed (for example, if the path is invalid).
         """
         self.file_path = leaked_credentials_path
-        self._credentials_data = []   # Will hold list of lines if loaded into memory
-        self._hash_credentials_data = [] # Will hold list of hashed leaked data into memory
+        self._credentials_data = _CSRRows([], [0])   # Will hold the rows of leaked plaintexts
+        self._hash_credentials_data = _CSRRows([], [0]) # Will hold the rows of interned prefix ids, sharing the same offsets
+        self._prefix_ids = {}   # Hash prefix -> int32 id
+        self._prefixes = []     # Id -> hash prefix
+        self._plaintext_index = None # Lazily built inverted index over the plaintext rows
 
-    def pre_compute(self, query_type: str, prefix_length: int) -> None:
+    def pre_compute(self, query_type: str, prefix_length: int, cache_dir: str = None) -> None:
         """
         Precompute the leaked dataset.
 
         This method loads the leaked dataset into memory and precomputes into hashed format. Note that we omit the progress of user connecting in leaked dataset. Therefore, the leaked dataset in self.file_path should be connected.
 
+        Parameters:
+            query_type (str): 'user', 'pass' or 'cred'.
+            prefix_length (int): Length of the hex hash prefixes.
+            cache_dir (str): Optional directory for the precomputed arrays (off by default). They are keyed by the
+                             leaked file's content, query_type and prefix_length, and memory-mapped on later runs.
+
         Returns:
             None.
 
@@ -55,27 +97,77 @@ class CredentialConnectingAttack:
             >>> attack = CredentialConnectingAttack("leaked_credentials.txt")
             >>> attack.pre_compute()
         """
+        if cache_dir is not None:
+            cache_prefix = os.path.join(cache_dir, cache_key(self.file_path, 'pre_compute', query_type, prefix_length))
+            cached = load_array_cache(cache_prefix, ('offsets', 'hashes'))
+            if cached is not None:
+                (offsets, hashes), (plaintext_flat, self._prefixes) = cached
+                self._prefix_ids = {prefix: i for i, prefix in enumerate(self._prefixes)}
+                self._hash_credentials_data = _CSRRows(hashes, offsets)
+                self._credentials_data = _CSRRows(plaintext_flat, offsets)
+                self._plaintext_index = None
+                return
+
+        sha256 = hashlib.sha256
+        digest_size = (prefix_length + 1) // 2 # only hex-format the digest bytes the prefix needs
+        # Rows are stored flat (CSR): one list of plaintexts, one int32 array of interned prefix ids
+        # and the row boundaries shared by both.
+        prefix_ids = {}
+        # Usernames and passwords repeat across rows, so each distinct one is hashed once. Credentials are
+        # all distinct, so 'cred' rows are hashed directly instead of filling a memo that never hits.
+        memoize = query_type != 'cred'
+        plaintext_prefix_ids = {}
+        plaintext_flat = []
+        hash_flat = []
+        offsets = [0]
         with open(self.file_path, 'r', encoding='utf-8') as f:
-            for line in tqdm(f, desc='precompute leaked dataset'):
+            for line in tqdm(f, desc='precompute leaked dataset', mininterval=5):
                 credentials = line.split('\t')[:-1]
-                hash_list = []
                 plaintext_list = []
                 if len(credentials) > 10:
-                    for c in credentials:
-                        credential = eval(c)
-                        username, password = credential
-                        if query_type == 'user':
-                            hash_list.append(hashlib.sha256(username.encode()).hexdigest()[:prefix_length])
-                            plaintext_list.append(username)
-                        elif query_type == 'pass':
-                            hash_list.append(hashlib.sha256(password.encode()).hexdigest()[:prefix_length])
-                            plaintext_list.append(password)
-                        elif query_type == 'cred':
-                            hash_list.append(hashlib.sha256(c.encode()).hexdigest()[:prefix_length])
-                            plaintext_list.append(c)
-                    self._hash_credentials_data.append(hash_list)
-                    self._credentials_data.append(plaintext_list)
+                    if query_type == 'user':
+                        plaintext_list = [parse_credential(c)[0] for c in credentials]
+                    elif query_type == 'pass':
+                        plaintext_list = [parse_credential(c)[1] for c in credentials]
+                    elif query_type == 'cred':
+                        # The string form of the parsed tuple, as query generation hashes and records it,
+                        # so list-form entries match too.
+                        plaintext_list = [str(parse_credential(c)) for c in credentials]
+                    for p in plaintext_list:
+                        prefix_id = plaintext_prefix_ids.get(p) if memoize else None
+                        if prefix_id is None:
+                            prefix = sha256(p.encode()).digest()[:digest_size].hex()[:prefix_length]
+                            prefix_id = prefix_ids.setdefault(prefix, len(prefix_ids))
+                            if memoize:
+                                plaintext_prefix_ids[p] = prefix_id
+                        hash_flat.append(prefix_id)
+                    plaintext_flat += plaintext_list
+                    offsets.append(len(plaintext_flat))
+
+        offsets = np.array(offsets, dtype=np.int64)
+        self._hash_credentials_data = _CSRRows(np.array(hash_flat, dtype=np.int32), offsets)
+        self._credentials_data = _CSRRows(plaintext_flat, offsets)
+        self._plaintext_index = None
+        self._prefix_ids = prefix_ids
+        self._prefixes = list(prefix_ids)
+
+        if cache_dir is not None:
+            save_array_cache(cache_prefix, {'offsets': offsets, 'hashes': self._hash_credentials_data.values},
+                             (plaintext_flat, self._prefixes))
+
+    def get_plaintext_index(self) -> tuple:
+        """
+        Get the inverted index from plaintexts to the precomputed leaked rows.
 
+        The index is built once from the rows loaded by `pre_compute` and can be shared with the evaluation
+        (e.g. `calculate_ideal_connected`) instead of re-reading and re-parsing the leaked dataset.
+
+        Returns:
+            tuple: (token_ids, offsets, postings) as returned by `src.utils.build_postings`.
+        """
+        if self._plaintext_index is None:
+            self._plaintext_index = build_postings(self._credentials_data, desc='Indexing leaked plaintexts')
+        return self._plaintext_index
 
     def run(self, identified_queries: list, min_overlap: int) -> list:
         """
@@ -87,56 +179,53 @@ class CredentialConnectingAttack:
 
         """
 
-        match_result_list = self._find_best_matches(identified_queries, self._hash_credentials_data, min_overlap)
+        # Prefixes never seen in the leaked dataset get distinct negative ids, which have no postings.
+        prefix_ids = self._prefix_ids
+        unknown_ids = {}
+        encoded_queries = [[prefix_ids[q] if q in prefix_ids else unknown_ids.setdefault(q, -1 - len(unknown_ids)) for q in a]
+                           for a in identified_queries]
+        prefixes = self._prefixes
+        unknown_prefixes = list(unknown_ids)
+        match_result_list = self._find_best_matches(encoded_queries, self._hash_credentials_data, min_overlap)
 
         connected_results = []
 
         match_test = set()
-        for idpos, (indices, details) in enumerate(match_result_list):
+        for idpos, indices, details in match_result_list:
             if len(indices) == 0:
                 continue
             for pos, det in enumerate(details):
-                matches_list = []
-                matches_hash_list = []
-                unmatches_list = []
-                other_candidate = []
-                for d in det:
-                    matches_list.append(self._credentials_data[indices[pos]][d])
-                    matches_hash_list.append(self._hash_credentials_data[indices[pos]][d])
-                if str(sorted(matches_list)) in match_test:
+                plaintext_row = self._credentials_data[indices[pos]]
+                hash_row = self._hash_credentials_data[indices[pos]]
+                matches_list = [plaintext_row[d] for d in det]
+                match_key = tuple(sorted(matches_list))
+                if match_key in match_test:
                     continue
-                match_test.add(str(sorted(matches_list)))
-                unmatches_list = list((Counter(identified_queries[idpos]) - Counter(matches_hash_list)).elements())
-                other_candidate = list((Counter(self._credentials_data[indices[pos]]) - Counter(matches_list)).elements())
+                match_test.add(match_key)
+                # The query side is diffed on interned ids and mapped back to prefixes at the end.
+                unmatched_ids = _multiset_diff(encoded_queries[idpos], hash_row[det].tolist())
+                unmatches_list = [prefixes[i] if i >= 0 else unknown_prefixes[-1 - i] for i in unmatched_ids]
+                other_candidate = _multiset_diff(plaintext_row, matches_list)
                 connected_results.append([matches_list, unmatches_list, other_candidate])
         
         return connected_results
     
-    def _find_best_matches(self, A: list, B: list, min_overlap: int) -> list:
-        index = defaultdict(set)
-        for i, b in tqdm(enumerate(B), total=len(B), desc='Preprocessing'):
-            for elem in set(b):
-                index[elem].add(i)
+    def _find_best_matches(self, A: list, B: _CSRRows, min_overlap: int) -> list:
+        # Rows of B hold interned prefix ids, so the postings are built vectorized and token t is id t.
+        num_tokens = len(self._prefixes)
+        offsets, postings = build_id_postings(B.values, B.offsets, num_tokens)
 
         results = []
-        for a in tqdm(A, total=len(A), desc='Finding'):
-            counter = Counter()
-            for elem in set(a):
-                for idx in index.get(elem, []):
-                    counter[idx] += 1
-            
-            if not counter:
+        for qid, a in tqdm(enumerate(A), total=len(A), desc='Finding', mininterval=5):
+            query = set(a)
+            parts = [postings[offsets[t]:offsets[t + 1]] for t in query if 0 <= t < num_tokens]
+            if not parts:
                 continue
-            
-            best_idx = max(counter, key=lambda x: counter[x])
 
-            if counter[best_idx] >= min_overlap:
-                pos_list = []
-                for item in set(a) & set(B[best_idx]):
-                    for i, x in enumerate(B[best_idx]):
-                        if x == item:
-                            pos_list.append(i)  
-                results.append(([best_idx],[pos_list]))
+            best_idx, overlap = most_common_row(np.concatenate(parts))
 
+            if overlap >= min_overlap:
+                pos_list = [i for i, x in enumerate(B[best_idx]) if x in query]
+                results.append((qid, [best_idx], [pos_list]))
 
-        return results
\ No newline at end of file
+        return results
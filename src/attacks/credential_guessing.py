@@ -10,10 +10,62 @@ These components are designed to integrate into a credential attack pipeline, wh
 hash information and password reuse are leveraged to increase guessing success.
 """
 
-import hashlib
 from tqdm import tqdm
-from collections import defaultdict, Counter
 import os
+from ast import literal_eval
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+import numpy as np
+from src.utils import sha256_prefixes, split_line_ranges, block_count, read_line_range, iter_plaintext_records, build_postings, most_common_row, cache_key, save_array_cache, load_array_cache
+
+_MAX_GUESSES = 1000 # Guesses per hash prefix that are ranked (q=1000)
+
+def _hash_guess_range(task) -> tuple:
+    """Read the guesses (one per line) in a byte range of a guess file and hash them to prefixes."""
+    file_path, start, end, prefix_length = task
+    guesses = read_line_range(file_path, start, end)
+    return guesses, sha256_prefixes(guesses, prefix_length)
+
+def _load_guess_table(file_path: str, prefix_length: int, workers: int = 1) -> dict:
+    """
+    Map hash prefixes to the guesses of a guess file (one per line) having them, in file order.
+
+    The file is split into line-aligned blocks (block_count) and each block is hashed independently, in
+    worker processes when workers > 1; blocks are merged in file order, with at most two per worker
+    in flight so finished blocks don't pile up ahead of the merge.
+    """
+    parts = block_count(file_path, workers * 4)
+    tasks = [(file_path, start, end, prefix_length) for start, end in split_line_ranges(file_path, parts)]
+    def hashed_ranges():
+        if workers <= 1:
+            yield from map(_hash_guess_range, tasks)
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for task in tasks:
+                pending.append(executor.submit(_hash_guess_range, task))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    guess_table = {}
+    for guesses, guess_hashes in tqdm(hashed_ranges(), total=len(tasks), desc="load guessing"):
+        for guess, guess_hash in zip(guesses, guess_hashes):
+            guess_table.setdefault(guess_hash, []).append(guess)
+    return guess_table
+
+def _guess_rank(target: str, guess_lists, limit: int = _MAX_GUESSES) -> int:
+    """Position of `target` in the concatenated guess lists, or `limit` if it is not among the first `limit` guesses."""
+    offset = 0
+    for guesses in guess_lists:
+        if offset >= limit:
+            break
+        try:
+            return offset + guesses.index(target, 0, limit - offset)
+        except ValueError:
+            offset += len(guesses)
+    return limit
 
 class CredentialGuessing:
 
@@ -35,20 +87,17 @@ class CredentialGuessing:
             list: A list of all old passwords.
         """
         with open(connected_result_path, 'r') as f, open(output_path, 'w') as w, open(output_pos_path, 'w') as p:
-            pos = 0
             old_password_set = set()
             for line in f:
-                matches_list, unmatches_list, other_candidate = eval(line)
-                for pw in matches_list:
-                    old_password_set.add(pw)
-                for pw in other_candidate:
-                    old_password_set.add(pw)
+                matches_list, unmatches_list, other_candidate = literal_eval(line)
+                old_password_set.update(matches_list)
+                old_password_set.update(other_candidate)
             for pw in old_password_set:
                 # Write a proper format for your targeted password guessing model
                 w.write('_'+'\t'+str(pw)+'\t'+str(pw)+'\n')
 
     @staticmethod
-    def run_guessing_and_match_hashes_rPGM(normal_guess_file_path: str, guess_file_path: str,  connected_result_path: str, origin_path: str, output_path: str, leak_set: set, prefix_length: int = 5) -> None:
+    def run_guessing_and_match_hashes_rPGM(normal_guess_file_path: str, guess_file_path: str,  connected_result_path: str, origin_path: str, output_path: str, leak_set: set, prefix_length: int = 5, workers: int = 1, cache_dir: str = None) -> None:
         """
         Match hashed guesses against known hash prefixes from the connected result file.
 
@@ -57,25 +106,17 @@ class CredentialGuessing:
             connected_result_path (str): File containing connected result with unmatched prefixes.
             output_path (str): File to write matched guesses by prefix.
             prefix_length (int): Number of hash characters to match (default: 5).
+            workers (int): Number of processes hashing the normal guess file (default: 1).
+            cache_dir (str): Optional directory for the connected-result index (off by default). It is keyed by
+                             the connected result file's content and prefix_length, so a rerun that rewrites the
+                             same connected result reuses it; the index is memory-mapped on later runs.
 
         Returns:
             dict: Mapping from prefix to list of matched password guesses.
         """
 
-        guess_table_normal = {}
-        num = 0
         # Load guessing password generated by password guessing model (non-targeted)
-        with open(normal_guess_file_path, 'r') as g:
-            for line in tqdm(g, desc="load guessing"):
-                num += 1
-                guess = line[:-1]
-                guess_hash = hashlib.sha256(guess.encode()).hexdigest()[:prefix_length]
-                if guess_hash in guess_table_normal:
-                    guess_table_normal[guess_hash].append(guess)
-                else:
-                    guess_table_normal[guess_hash] = []
-                    guess_table_normal[guess_hash].append(guess)
-
+        guess_table_normal = _load_guess_table(normal_guess_file_path, prefix_length, workers)
 
         old_password_table = {}
         # Load guessing password generated by targeted password guessing model
@@ -83,71 +124,86 @@ class CredentialGuessing:
             for line in tqdm(g,desc="load old guess"):
 
                 # This can any form that loading guess dictionary for target old password
-                _, target_password, guesses = g.readline().split('\t')
+                _, target_password, guesses = line.split('\t')
 
                 target_password = target_password.replace(" ", "")
-                if target_password not in old_password_table:
-                    old_password_table[target_password] = guesses # non-eval
-
-        index = defaultdict(set)
-        connected_list = []
-        with open(connected_result_path, 'r', encoding='utf8') as c:
-            connected_pos = 0
-            for line in tqdm(c,desc="load connect result"):
-                match_list, unmatches_hash, other_candidate = eval(line)
-                connected_list.append(match_list + other_candidate)
-                for matches in match_list:
-                    hashed = hashlib.sha256(matches.encode()).hexdigest()[:prefix_length]
-                    index[hashed].add(connected_pos)
-                for unmatches in unmatches_hash:
-                    index[unmatches].add(connected_pos)
-                connected_pos += 1
-
-
-        with open(origin_path, 'r') as f, open(guess_file_path, 'r') as g, open(output_path, 'w') as w:
+                old_password_table.setdefault(target_password, guesses) # parsed on first use
+
+        # Old passwords are hashed while indexing the connected result and hashed again as guesses
+        # for every target connected to them, so their prefixes are cached across both passes.
+        pw_prefix_cache = {}
+        def cached_prefixes(passwords):
+            missing = [pw for pw in passwords if pw not in pw_prefix_cache]
+            pw_prefix_cache.update(zip(missing, sha256_prefixes(missing, prefix_length)))
+            return [pw_prefix_cache[pw] for pw in passwords]
+
+        cache_prefix = None
+        if cache_dir is not None:
+            cache_prefix = os.path.join(cache_dir, cache_key(connected_result_path, 'connected_index', prefix_length))
+        cached = load_array_cache(cache_prefix, ('offsets', 'postings')) if cache_prefix is not None else None
+        if cached is not None:
+            (offsets, postings), (connected_list, prefixes) = cached
+            prefix_ids = {prefix: i for i, prefix in enumerate(prefixes)}
+        else:
+            connected_list = []
+            connected_prefixes = []
+            with open(connected_result_path, 'r', encoding='utf8') as c:
+                for line in tqdm(c,desc="load connect result"):
+                    match_list, unmatches_hash, other_candidate = literal_eval(line)
+                    connected_list.append(match_list + other_candidate)
+                    connected_prefixes.append(cached_prefixes(match_list) + unmatches_hash)
+            # Prefix -> connected positions, frozen into CSR arrays
+            prefix_ids, offsets, postings = build_postings(connected_prefixes, desc='index connect result')
+            del connected_prefixes
+            if cache_prefix is not None:
+                save_array_cache(cache_prefix, {'offsets': offsets, 'postings': postings}, (connected_list, list(prefix_ids)))
+
+
+        with open(output_path, 'w') as w:
             leak_num = 0
             unleak_num = 0
             guess_leak = [0, 0, 0, 0]
             guess_unleak = [0, 0, 0, 0]
             
             past_pos = 0
-            for line in tqdm(f,desc="Conduct guessing"):
+            for posp, _, unmatches_list, plaintext in tqdm(iter_plaintext_records(origin_path), desc="Conduct guessing"):
                 targeted_guess_table = {}
-                posp, _, unmatches_list, plaintext = eval(line)
-                counter = Counter()
-                for unmatches in unmatches_list:
-                    for idx in index.get(unmatches, []):
-                        counter[idx] += 1
-                if not counter:
+                # Count the shared prefixes per connected entry (lowest position on ties).
+                hits = [postings[offsets[t]:offsets[t + 1]] for t in (prefix_ids.get(u) for u in unmatches_list) if t is not None]
+                if not hits:
                     continue
-                best_idx = max(counter, key=lambda x: counter[x])
-                if counter[best_idx] < 2:
+                best_idx, best_val = most_common_row(np.concatenate(hits))
+                if best_val < 2:
                     continue
                 old_list = connected_list[best_idx]
+                unmatches_set = frozenset(unmatches_list)
                 _guess_list = []
                 for old in set(old_list):
-                    _guess_list.append(eval(old_password_table[old]))                      
+                    guesses = old_password_table[old]
+                    if isinstance(guesses, str):
+                        guesses = old_password_table[old] = literal_eval(guesses)
+                    _guess_list.append(guesses)
 
-                
-                guess_list = [guess for guesses in zip(*_guess_list) for guess in guesses]
-
-                for guess in set(old_list):
-                    guess_hash = hashlib.sha256(guess.encode()).hexdigest()[:prefix_length]
-                    if guess_hash in unmatches_list:
-                        if guess_hash in targeted_guess_table:
-                            targeted_guess_table[guess_hash].append(guess)
-                        else:
-                            targeted_guess_table[guess_hash] = []
-                            targeted_guess_table[guess_hash].append(guess)
-
-                for guess in guess_list:
-                    guess_hash = hashlib.sha256(guess.encode()).hexdigest()[:prefix_length]
-                    if guess_hash in unmatches_list:
-                        if guess_hash in targeted_guess_table:
-                            targeted_guess_table[guess_hash].append(guess)
-                        else:
-                            targeted_guess_table[guess_hash] = []
-                            targeted_guess_table[guess_hash].append(guess)
+                old_guesses = list(set(old_list))
+                for guess, guess_hash in zip(old_guesses, cached_prefixes(old_guesses)):
+                    if guess_hash in unmatches_set:
+                        targeted_guess_table.setdefault(guess_hash, []).append(guess)
+
+                # Interleave the guess lists lazily and hash them in batches; only the first
+                # _MAX_GUESSES guesses of a prefix are ranked, so stop once every unmatched prefix
+                # has that many.
+                guess_iter = chain.from_iterable(zip(*_guess_list))
+                full = sum(len(bucket) >= _MAX_GUESSES for bucket in targeted_guess_table.values())
+                while full < len(unmatches_set):
+                    guess_list = list(islice(guess_iter, _MAX_GUESSES))
+                    if not guess_list:
+                        break
+                    for guess, guess_hash in zip(guess_list, sha256_prefixes(guess_list, prefix_length)):
+                        if guess_hash in unmatches_set:
+                            bucket = targeted_guess_table.setdefault(guess_hash, [])
+                            if len(bucket) < _MAX_GUESSES:
+                                bucket.append(guess)
+                                full += len(bucket) == _MAX_GUESSES
                 
                 for pos, hashes in enumerate(unmatches_list):
                     leak_flag = False
@@ -156,33 +212,13 @@ class CredentialGuessing:
                         leak_flag = True
                     else:
                         unleak_num += 1
-                    guess_list_final = []
-                    if hashes in targeted_guess_table:
-                        guess_list_final += targeted_guess_table[hashes]
-                    if hashes in guess_table_normal:
-                        guess_list_final += guess_table_normal[hashes]
-                        
-                    matches_list = guess_list_final[:1000]
-                    if plaintext[pos] in matches_list[0]:
-                        if leak_flag:
-                            guess_leak[0] += 1
-                        else:
-                            guess_unleak[0] += 1
-                    if plaintext[pos] in matches_list[:10]:
-                        if leak_flag:
-                            guess_leak[1] +=1
-                        else:
-                            guess_unleak[1] += 1
-                    if plaintext[pos] in matches_list[:100]:
-                        if leak_flag:
-                            guess_leak[2] +=1
-                        else:
-                            guess_unleak[2] +=1
-                    if plaintext[pos] in matches_list:
-                        if leak_flag:
-                            guess_leak[3] += 1
-                        else:
-                            guess_unleak[3] += 1
+                    # Targeted guesses are tried before the normal ones; q=1/10/100/1000 count the
+                    # plaintexts cracked within that many guesses.
+                    rank = _guess_rank(plaintext[pos], (targeted_guess_table.get(hashes, []), guess_table_normal.get(hashes, [])))
+                    guess_count = guess_leak if leak_flag else guess_unleak
+                    for q, threshold in enumerate((1, 10, 100, 1000)):
+                        if rank < threshold:
+                            guess_count[q] += 1
 
             if leak_num == 0:
                 w.write("leak num:" + str(leak_num) + "\n")
@@ -25,6 +25,9 @@ Example:
 This module is intended to be used as part of a larger simulation and attack framework.
 """
 
+from bisect import bisect_left, insort
+from collections import deque
+
 class LIdentifyingAttack:
     """
     LIdentifyingAttack implements a streaming algorithm for simulating a C3 server attack.
@@ -44,7 +47,8 @@ class LIdentifyingAttack:
             prune_interval (int): Number of queries to process before triggering pruning.
         """
         self._query_dict = {}     # Placeholder for storing processed queries.
-        self._current_window = []   # Placeholder for storing current slide window.
+        self._current_window = deque(maxlen=length_l)   # Current slide window; appending evicts the oldest query.
+        self._sorted_window = []   # Same queries as the window, kept sorted.
         self._query_count = 0     # Counter for the number of queries processed.
         self._l = length_l  # Set the parameter l for this attack.
         self._prune_threshold = prune_threshold # Controls the minimal counter to prune.
@@ -60,27 +64,51 @@ class LIdentifyingAttack:
         Returns:
             None
         """
-        if not isinstance(query, str):
-            raise TypeError("Input query must be a string.")
-
-        self._query_count += 1
-        self._current_window.append(query)
-
-        if len(self._current_window) >= self._l:
-            subseq = tuple(sorted(self._current_window[:self._l]))
-            if subseq in self._query_dict:
-                self._query_dict[subseq] += 1
-            else:
-                self._query_dict[subseq] = 1
-            if len(set(subseq)) < len(subseq):
-                self._query_dict[subseq] += 0
-
-        if len(self._current_window) > self._l:
-            self._current_window.pop(0)
-
-        # Perform pruning if needed
-        if self._query_count % self._prune_interval == 0:
-            self._prune()
+        self.process_batch((query,))
+
+    def process_batch(self, queries) -> None:
+        """
+        Process a batch of input query strings, in order.
+
+        This is equivalent to calling `process` on every query, but the per-query work runs in a
+        single loop with the attack state bound to locals, which removes the per-call overhead on
+        long query streams.
+
+        Args:
+            queries (iterable): The input query strings to be processed.
+
+        Returns:
+            None
+        """
+        l = self._l
+        window, sorted_window = self._current_window, self._sorted_window
+        query_dict = self._query_dict
+        prune_interval = self._prune_interval
+        count = self._query_count
+        try:
+            for query in queries:
+                if not isinstance(query, str):
+                    raise TypeError("Input query must be a string.")
+
+                count += 1
+                # One query enters and at most one leaves per step, so the sorted copy is updated
+                # in place instead of re-sorting the whole window.
+                if len(window) == l:
+                    sorted_window.pop(bisect_left(sorted_window, window[0]))
+                window.append(query)
+                insort(sorted_window, query)
+
+                if len(window) == l:
+                    subseq = tuple(sorted_window)
+                    query_dict[subseq] = query_dict.get(subseq, 0) + 1
+
+                # Perform pruning if needed
+                if count % prune_interval == 0:
+                    self._query_count = count
+                    self._prune()
+                    query_dict = self._query_dict
+        finally:
+            self._query_count = count
 
     def get_result(self) -> dict:
         """
@@ -69,15 +69,18 @@ class RangeCombiningAttack:
         for pos, l in enumerate(self._lengths_processed):
             if l < query_length:
                 smaller_pos = pos
-                for subseq in result_dict.keys():
-                    for i in range(query_length-l):
-                        if subseq[i:i+l] in self._combined_results[pos]:
-                            self._combined_results[pos].pop(subseq[i:i+l])
+                shorter = self._combined_results[pos]
+                for subseq in result_dict:
+                    for i in range(query_length-l+1):
+                        s = subseq[i:i+l]
+                        if s in shorter:
+                            del shorter[s]
             elif l > query_length:
-                for subseq in self._combined_results[pos].keys():
-                    for i in range(l-query_length):
-                        if subseq[i:i+query_length] in result_dict:
-                            result_dict.pop(subseq[i:i+query_length])
+                for subseq in self._combined_results[pos]:
+                    for i in range(l-query_length+1):
+                        s = subseq[i:i+query_length]
+                        if s in result_dict:
+                            del result_dict[s]
             elif l == query_length:
                 smaller_pos = pos
         # combined the pruned dictionary
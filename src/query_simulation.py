@@ -18,9 +18,55 @@ from tqdm import tqdm
 import random
 import string
 import hashlib
-from src.utils import load_leaked_dataset
+import os
+import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import chain, repeat
+from operator import itemgetter
+import numpy as np
+from src.utils import load_leaked_dataset, leaked_key, parse_credential, plaintext_sidecar_path, split_line_ranges, block_count, read_line_range
 
-def split_data(input_file_path: str, output_leak_path: str, output_source_path: str, split_ratio: float = 0.9, method: str = 'credentials') -> None:
+_ALPHABET = string.ascii_letters + string.digits # Characters of the random passwords set on clean/active events
+
+def _password_pool(batch_size: int = 10000):
+    """Yield random 12-character passwords, drawn from the random stream batch_size at a time."""
+    while True:
+        chars = ''.join(random.choices(_ALPHABET, k=12 * batch_size))
+        for start in range(0, len(chars), 12):
+            yield chars[start:start + 12]
+
+def _draw_stream(draw, batch_size: int = 1 << 16):
+    """Return a next() function over the values of draw(batch_size), a numpy draw refilled as it runs out."""
+    return chain.from_iterable(draw(n).tolist() for n in repeat(batch_size)).__next__
+
+def _split_credentials_range(task) -> None:
+    """Split the credentials in a byte range of the original dataset into a leaked and a source shard file."""
+    file_path, start, end, split_ratio, seed, leak_shard_path, source_shard_path = task
+    rand = random.Random(seed).random
+    lines = read_line_range(file_path, start, end)
+    with open(leak_shard_path, 'w', encoding='utf-8') as leak_file, \
+         open(source_shard_path, 'w', encoding='utf-8') as source_file:
+        for line in lines:
+            credentials = line.split('\t')[:-1]
+            breach_part = []
+            query_part = []
+            for c in credentials:
+                if rand() < split_ratio:
+                    breach_part.append(c)
+                else:
+                    query_part.append(c)
+            for b in breach_part:
+                leak_file.write(str(b)+'\t')
+            if breach_part:
+                leak_file.write('\n')
+            for q in query_part:
+                source_file.write(str(q)+'\t')
+            if query_part:
+                source_file.write('\n')
+
+def split_data(input_file_path: str, output_leak_path: str, output_source_path: str, split_ratio: float = 0.9, method: str = 'credentials', workers: int = 1) -> None:
     """
     Splits the original dataset into two parts: leaked and source datasets.
 
@@ -34,6 +80,7 @@ def split_data(input_file_path: str, output_leak_path: str, output_source_path:
         method (str): Splitting method:
             - 'users': load all data, shuffle, then split the users.
             - 'credentials': decide for each line probabilistically, then split the credentials.
+        workers (int): Number of processes splitting the shards of the file in 'credentials' mode.
 
     Returns:
         None. Outputs are written to files.
@@ -50,31 +97,36 @@ def split_data(input_file_path: str, output_leak_path: str, output_source_path:
             source_file.writelines(lines[cutoff:])
     elif method == 'credentials':
         # shuffle the credentials
-        with open(input_file_path, 'r', encoding='utf-8') as f, \
-             open(output_leak_path, 'w', encoding='utf-8') as leak_file, \
-             open(output_source_path, 'w', encoding='utf-8') as source_file:
-            for line in f:
-                credentials = line.split('\t')[:-1]
-                breach_part = []
-                query_part = []
-                for c in credentials:
-                    if random.random() < split_ratio:
-                        breach_part.append(c)
-                    else:
-                        query_part.append(c)
-                for b in breach_part:
-                    leak_file.write(str(b)+'\t')
-                if breach_part:
-                    leak_file.write('\n')
-                for q in query_part:
-                    source_file.write(str(q)+'\t')
-                if query_part:
-                    source_file.write('\n')
+        # The file is cut into line-aligned shards (block_count), each split with its own seed drawn from
+        # the random module in shard order, so the result depends on random.seed but not on workers.
+        # Every shard writes its own pair of temporary files, which are concatenated in order and removed
+        # as they are copied; any left behind by a failed or interrupted run are removed on the way out.
+        ranges = split_line_ranges(input_file_path, block_count(input_file_path))
+        tasks = [(input_file_path, start, end, split_ratio, random.getrandbits(64), f'{output_leak_path}.{i}.tmp', f'{output_source_path}.{i}.tmp')
+                 for i, (start, end) in enumerate(ranges)]
+        try:
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(_split_credentials_range, tasks))
+            else:
+                for task in tasks:
+                    _split_credentials_range(task)
+            with open(output_leak_path, 'wb') as leak_file, open(output_source_path, 'wb') as source_file:
+                for task in tasks:
+                    for shard_path, output_file in ((task[5], leak_file), (task[6], source_file)):
+                        with open(shard_path, 'rb') as shard_file:
+                            shutil.copyfileobj(shard_file, output_file)
+                        os.remove(shard_path)
+        finally:
+            for task in tasks:
+                for shard_path in task[5:]:
+                    if os.path.exists(shard_path):
+                        os.remove(shard_path)
     else:
         raise ValueError(f"Unsupported split method: {method}")
     
 
-def generate_queries(leak_file_path: str, source_file_path: str, num_queries: int, query_length: int, query_type: str, scenario_config: dict, output_query_path: str, output_plaintext_path: str) -> None:
+def generate_queries(leak_file_path: str, source_file_path: str, num_queries: int, query_length: int, query_type: str, scenario_config: dict, output_query_path: str, output_plaintext_path: str, legacy_plaintext: bool = False) -> None:
     """
     Generates queries using data from the leaked and source datasets.
 
@@ -89,154 +141,173 @@ def generate_queries(leak_file_path: str, source_file_path: str, num_queries: in
             - 'cred': generate queries from credentials.
         scenario_config (tuple): A 4-element tuple specifying scenario parameters: %asyn, %clean, %intercept, %active.
         output_query_path (str): File path to save the generated queries.
-        output_plaintext_path (str): File path to save the plaintext of generated queries.
+        output_plaintext_path (str): File path of the plaintext of generated queries. The records are
+            pickled to `src.utils.plaintext_sidecar_path(output_plaintext_path)`; read them back with
+            `src.utils.iter_plaintext_records(output_plaintext_path)`.
+        legacy_plaintext (bool): Write the records to output_plaintext_path itself in the legacy text
+            format, one str(record) per line, instead of the pickle sidecar (default: False). Output
+            of an earlier run in either format is removed first.
 
     Returns:
         None. Queries are written to file.
     """
 
+    # Credentials are parsed once into (username, password) tuples; a 'cred' query hashes the
+    # tuple's string form.
     query_user_list = [] # record the query users
     with open(source_file_path, 'r', encoding='utf-8') as source_file:
         for line in tqdm(source_file, desc='Loading query source'):
             credentials = line.split('\t')[:-1]
-            query_user_list.append(credentials)
+            query_user_list.append([parse_credential(c) for c in credentials])
+
+    # For 'pass' and 'cred' the leaked set holds 64-bit keys cut from the SHA-256 of each leaked text, so
+    # a query is tested with the digest it is already hashed with. A 'user' query hashes only the
+    # username but is tested on the whole credential, so that set keeps the credential tuples.
+    if query_type == 'user':
+        leaked_set = load_leaked_dataset(leak_file_path, query_type, parsed=True)
+    else:
+        leaked_set = load_leaked_dataset(leak_file_path, query_type, hashed=True)
 
-    leaked_set = load_leaked_dataset(leak_file_path, query_type)
+    # Only the digest bytes covering the prefix are hex-formatted, and the prefix is kept as the encoded
+    # output line. PM users re-query the same vault entries over and over, so recent results are
+    # memoized (bounded to keep memory flat).
+    sha256 = hashlib.sha256
+    digest_size = (query_length + 1) // 2
+    def line_and_key(digest):
+        return (digest[:digest_size].hex()[:query_length] + '\n').encode(), leaked_key(digest)
+    @lru_cache(maxsize=1 << 20)
+    def hash_query(text):
+        return line_and_key(sha256(text.encode()).digest())
+    def query_line(text):
+        return hash_query(text)[0]
 
+    # A credential is hashed as str((user, password)) == '(' + repr(user) + ', ' + repr(password) + ')'.
+    # Results are memoized on the tuple itself so hits skip formatting it, and a miss continues from
+    # the hash state of the username part, which a PM user's vault shares across entries.
+    @lru_cache(maxsize=1 << 16)
+    def username_state(username):
+        return sha256(('(' + repr(username) + ', ').encode())
+    @lru_cache(maxsize=1 << 20)
+    def hash_credential(credential):
+        h = username_state(credential[0]).copy()
+        h.update((repr(credential[1]) + ')').encode())
+        return line_and_key(h.digest())
+
+    # The query type is dispatched once: hash_entry gives a credential's query line and leaked-set key,
+    # entry_line its query line alone (intercepted queries are not tested against the leak), and
+    # content_of the plaintext recorded for it.
+    if query_type == 'user': # username-based queries, leak tested on the credential tuple itself
+        hash_entry = lambda c: (query_line(c[0]), c)
+        entry_line = lambda c: query_line(c[0])
+        content_of = itemgetter(0)
+    elif query_type == 'pass': # password-based queries
+        hash_entry = lambda c: hash_query(c[1])
+        entry_line = lambda c: query_line(c[1])
+        content_of = itemgetter(1)
+    else: # username-password-based queries
+        hash_entry = hash_credential
+        entry_line = lambda c: hash_credential(c)[0]
+        content_of = str
+
+    rand_pw = _password_pool().__next__ # passwords set on clean/active events, generated in bulk
+    # User picks and scenario events are drawn in numpy batches, one stream per kind, and read back one
+    # value at a time. An event stream already yields the outcome, so it costs less per test than
+    # random.random() plus the scenario_config lookup and comparison it replaces. The generator is
+    # seeded from the random module, so random.seed still fixes the whole series.
+    rng = np.random.default_rng(random.getrandbits(64))
+    pick_user = _draw_stream(lambda n: rng.integers(0, len(query_user_list), size=n))
+    asyn_event = _draw_stream(lambda n: rng.random(n) < scenario_config['asyn'])
+    clean_event = _draw_stream(lambda n: rng.random(n) < scenario_config['clean'])
+    intercept_event = _draw_stream(lambda n: rng.random(n) < scenario_config['intercept'])
+    active_event = _draw_stream(lambda n: rng.random(n) < scenario_config['active'])
     generated_query_series_num = 0 # a counter
     query_pm_user_frequency = {} # to record the frequency of queries of each password manager users
-    hash_prefix_file = open(output_query_path, 'w', encoding='utf-8')
-    origin_plaintext_file = open(output_plaintext_path, 'w', encoding='utf-8')
-
-    while generated_query_series_num < num_queries: # generate query
-        query_user = random.randint(0, len(query_user_list)-1)
-        query_content = query_user_list[query_user]
-        if len(query_user_list[query_user]) == 1: # an ordinary user
-            query_content = eval(query_content[0])
-            if query_type == 'user':
-                query = hashlib.sha256(query_content[0].encode()).hexdigest()
-                hash_prefix_file.write(query[:query_length]+'\n')
-                if str(query_content) in leaked_set:
-                    if random.random() < scenario_config['clean']:
-                        query_user_list[query_user].remove(str(query_content))
-                        query_user_list[query_user].append(str([query_content[0], "".join(random.choice(string.ascii_letters+string.digits) for _ in range(12))]))
-                generated_query_series_num += 1
-            elif query_type == 'pass':
-                query = hashlib.sha256(query_content[1].encode()).hexdigest()
-                hash_prefix_file.write(query[:query_length]+'\n')
-                if query_content[1] in leaked_set:
-                    if random.random() < scenario_config['clean']:
-                        query_user_list[query_user].remove(str(query_content))
-                        query_user_list[query_user].append(str([query_content[0], "".join(random.choice(string.ascii_letters+string.digits) for _ in range(12))]))
-                generated_query_series_num += 1
-            elif query_type == 'cred':
-                query = hashlib.sha256(str(query_content).encode()).hexdigest()
-                hash_prefix_file.write(query[:query_length]+'\n')
-                if str(query_content) in leaked_set:
-                    if random.random() < scenario_config['clean']:
-                        query_user_list[query_user].remove(str(query_content))
-                        query_user_list[query_user].append(str([query_content[0], "".join(random.choice(string.ascii_letters+string.digits) for _ in range(12))]))
-                generated_query_series_num += 1
-        else: # a password manager user
-            if query_user in query_pm_user_frequency:
-                query_pm_user_frequency[query_user] += 1
-            else:
-                query_pm_user_frequency[query_user] = 1
+    # Query lines are collected in a bytearray and written in blocks of about 64KB straight to the file
+    # descriptor, one write(2) per block with no io buffering layer in between.
+    query_fd = os.open(output_query_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    def flush_queries():
+        written = 0
+        with memoryview(query_buffer) as view:
+            while written < len(view):
+                written += os.write(query_fd, view[written:])
+        query_buffer.clear()
+    query_buffer = bytearray()
+
+    try:
+        shuffle, choice, randrange = random.shuffle, random.choice, random.randrange # bound once for the loop
+        while generated_query_series_num < num_queries: # generate query
+            if len(query_buffer) >= 1 << 16:
+                flush_queries()
+            query_user = pick_user()
             query_content = query_user_list[query_user]
-            if random.random() < scenario_config['asyn']:
-                random.shuffle(query_content)
-            if query_type == 'user':
-                if not query_content:
-                    continue
-                for c in query_content:
-                    c = eval(c)
-                    if random.random() < scenario_config['intercept']:
-                        _query_user = random.choice(query_user_list)
-                        if not _query_user:
-                            continue
-                        query = hashlib.sha256(eval(random.choice(_query_user))[0].encode()).hexdigest()
-                        hash_prefix_file.write(query[:query_length]+'\n')
-                        generated_query_series_num += 1
-                    query = hashlib.sha256(c[0].encode()).hexdigest()
-                    hash_prefix_file.write(query[:query_length]+'\n')
-                    if str(c) in leaked_set:
-                        if random.random() < scenario_config['clean']:
-                            query_user_list[query_user].remove(str(c))
-                            query_user_list[query_user].append(str([c[0], "".join(random.choice(string.ascii_letters+string.digits) for _ in range(12))]))
-                    generated_query_series_num += 1
-            elif query_type == 'pass':
-                if not query_content:
-                    continue
-                for c in query_content:
-                    c = eval(c)
-                    if random.random() < scenario_config['intercept']:
-                        _query_user = random.choice(query_user_list)
-                        if not _query_user:
-                            continue
-                        query = hashlib.sha256(eval(random.choice(_query_user))[1].encode()).hexdigest()
-                        hash_prefix_file.write(query[:query_length]+'\n')
-                        generated_query_series_num += 1
-                    query = hashlib.sha256(c[1].encode()).hexdigest()
-                    hash_prefix_file.write(query[:query_length]+'\n')
-                    if c[1] in leaked_set:
-                        if random.random() < scenario_config['clean']:
-                            query_user_list[query_user].remove(str(c))
-                            query_user_list[query_user].append(str([c[0], "".join(random.choice(string.ascii_letters+string.digits) for _ in range(12))]))
-                    generated_query_series_num += 1
-            elif query_type == 'cred':
+            if len(query_content) == 1: # an ordinary user
+                c = query_content[0]
+                line, key = hash_entry(c)
+                query_buffer += line
+                if key in leaked_set:
+                    if clean_event():
+                        query_content[0] = (c[0], rand_pw())
+                generated_query_series_num += 1
+            else: # a password manager user
+                if query_user in query_pm_user_frequency:
+                    query_pm_user_frequency[query_user] += 1
+                else:
+                    query_pm_user_frequency[query_user] = 1
+                if asyn_event():
+                    shuffle(query_content)
                 if not query_content:
                     continue
-                for c in query_content:
-                    c = eval(c)
-                    if random.random() < scenario_config['intercept']:
-                        _query_user = random.choice(query_user_list)
+                # A cleaned credential is replaced at its index, so each vault pass visits every entry once
+                # and no mutation has to search the vault.
+                for i, c in enumerate(query_content):
+                    if intercept_event():
+                        _query_user = query_user_list[pick_user()]
                         if not _query_user:
                             continue
-                        query = hashlib.sha256(random.choice(_query_user).encode()).hexdigest()
-                        hash_prefix_file.write(query[:query_length]+'\n')
+                        query_buffer += entry_line(choice(_query_user))
                         generated_query_series_num += 1
-                    query = hashlib.sha256(str(c).encode()).hexdigest()
-                    hash_prefix_file.write(query[:query_length]+'\n')
-                    if str(c) in leaked_set:
-                        if random.random() < scenario_config['clean']:
-                            query_user_list[query_user].remove(str(c))
-                            query_user_list[query_user].append(str([c[0], "".join(random.choice(string.ascii_letters+string.digits) for _ in range(12))]))
+                    line, key = hash_entry(c)
+                    query_buffer += line
+                    if key in leaked_set:
+                        if clean_event():
+                            query_content[i] = (c[0], rand_pw())
                     generated_query_series_num += 1
-            
-            if random.random() < scenario_config['active']: # insert a new credential
-                query_user_list[query_user].append(str([eval(random.choice(query_user_list[query_user]))[0], "".join(random.choice(string.ascii_letters+string.digits) for _ in range(12))]))
-            if random.random() < scenario_config['active']: # delete a credential
-                if query_user_list[query_user]:
-                    query_user_list[query_user].remove(random.choice(query_user_list[query_user]))
-            if random.random() < scenario_config['active']: # update a credential
-                if query_user_list[query_user]:
-                    updated_credential = random.choice(query_user_list[query_user])
-                    query_user_list[query_user].remove(updated_credential)
-                    query_user_list[query_user].append(str([eval(updated_credential)[0], "".join(random.choice(string.ascii_letters+string.digits) for _ in range(12))]))
+
+                # query_content is the user's vault itself, so the events below mutate it in place.
+                if active_event(): # insert a new credential
+                    query_content.append((choice(query_content)[0], rand_pw()))
+                if active_event(): # delete a credential
+                    if query_content:
+                        query_content.pop(randrange(len(query_content)))
+                if active_event(): # update a credential
+                    if query_content:
+                        updated = randrange(len(query_content))
+                        query_content[updated] = (query_content[updated][0], rand_pw())
+        flush_queries()
+    finally:
+        os.close(query_fd)
     print('Query series generated')
 
-    for user in query_pm_user_frequency.keys():
-        prefix_list = []
-        content_list = []
-        if query_type == 'user': # username-based prefix
-            for p in query_user_list[user]:
-                p = eval(p)
-                query = hashlib.sha256(p[0].encode()).hexdigest()
-                content_list.append(p[0])
-                prefix_list.append(query[:query_length])
-        elif query_type == 'pass': # password-based prefix
-            for p in query_user_list[user]:
-                p = eval(p)
-                query = hashlib.sha256(p[1].encode()).hexdigest()
-                content_list.append(p[1])
-                prefix_list.append(query[:query_length])
-        elif query_type == 'cred': # username-password-based prefix
-            for p in query_user_list[user]:
-                query = hashlib.sha256(p.encode()).hexdigest()
-                content_list.append(p)
-                prefix_list.append(query[:query_length])
-        origin_plaintext_file.write(str((user, query_pm_user_frequency[user], prefix_list, content_list)) + '\n')
-    print('Results generated')
-
-    hash_prefix_file.close()
-    origin_plaintext_file.close()
\ No newline at end of file
+    # The prefixes are read back from the generation-time memo, which is keyed by content: a PM user's
+    # surviving credentials were almost all queried during the run, so only those set by an active
+    # event after the user's last query (or evicted from the memo) are hashed again here.
+    pm_users = list(query_pm_user_frequency.keys())
+    # Records are pickled one after another to the sidecar (or formatted as text lines with
+    # legacy_plaintext), straight to a 1MB buffered file. The sidecar is written under a temporary
+    # name and only renamed into place once complete, so a failed run never leaves a truncated one.
+    sidecar_path = plaintext_sidecar_path(output_plaintext_path)
+    for stale_path in (sidecar_path, output_plaintext_path):
+        if os.path.exists(stale_path):
+            os.remove(stale_path) # records of an earlier run would be read in place of the new ones
+    with open(output_plaintext_path if legacy_plaintext else sidecar_path + '.tmp', 'wb', buffering=1 << 20) as origin_plaintext_file:
+        for user in pm_users:
+            content_list = [content_of(p) for p in query_user_list[user]]
+            prefix_list = [entry_line(p)[:-1].decode() for p in query_user_list[user]]
+            record = (user, query_pm_user_frequency[user], prefix_list, content_list)
+            if legacy_plaintext:
+                origin_plaintext_file.write((str(record) + '\n').encode('utf-8'))
+            else:
+                pickle.dump(record, origin_plaintext_file, protocol=pickle.HIGHEST_PROTOCOL)
+    if not legacy_plaintext:
+        os.replace(sidecar_path + '.tmp', sidecar_path)
+    print('Results generated')
\ No newline at end of file
@@ -1,45 +1,220 @@
 from tqdm import tqdm
 import json
+import ast
+import hashlib
+import mmap
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
 def load_config(config_path):
     with open(config_path, "r") as f:
         return json.load(f)
 
-def load_plaintext_series(file_path, windows_low, windows_high, min_count):
+def cache_key(file_path, *params):
+    # Name a derived artifact after its source file's content and the parameters it was built with.
+    # Content rather than mtime, so a file rewritten with the same data (e.g. re-split with the same
+    # seed) maps to the same single entry.
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    digest.update('|'.join(str(p) for p in params).encode())
+    return digest.hexdigest()
+
+def save_array_cache(cache_prefix, arrays, obj):
+    # Save a cache entry: each named array to cache_prefix_<name>.npy, then obj pickled to
+    # cache_prefix.pkl. The pickle marks the entry as complete, so it is written under a temporary
+    # name and only renamed into place once the rest is on disk.
+    os.makedirs(os.path.dirname(cache_prefix) or '.', exist_ok=True)
+    for name, array in arrays.items():
+        np.save(f'{cache_prefix}_{name}.npy', array)
+    with open(cache_prefix + '.pkl.tmp', 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_prefix + '.pkl.tmp', cache_prefix + '.pkl')
+
+def load_array_cache(cache_prefix, names):
+    # Load a complete cache entry saved by save_array_cache as ([arrays in `names` order], obj), with
+    # the arrays memory-mapped; None if there is no complete entry.
+    if not os.path.exists(cache_prefix + '.pkl'):
+        return None
+    arrays = [np.load(f'{cache_prefix}_{name}.npy', mmap_mode='r') for name in names]
+    with open(cache_prefix + '.pkl', 'rb') as f:
+        return arrays, pickle.load(f)
+
+def sha256_prefixes(strings, prefix_length):
+    # Hex SHA-256 prefixes of a batch of strings (or already UTF-8 encoded bytes), with the
+    # constructor bound once and only the digest bytes the prefix needs hex-formatted.
+    # The loop is specialized once on the prefix length: even lengths are whole digest bytes and
+    # need no trailing slice.
+    sha256 = hashlib.sha256
+    digest_size = (prefix_length + 1) // 2
+    if prefix_length % 2 == 0:
+        return [sha256(s if isinstance(s, bytes) else s.encode()).digest()[:digest_size].hex() for s in strings]
+    return [sha256(s if isinstance(s, bytes) else s.encode()).digest()[:digest_size].hex()[:prefix_length] for s in strings]
+
+def parse_credential(credential):
+    # Plain "('user', 'pass')" / "['user', 'pass']" entries are split directly; anything quoted
+    # differently or containing escapes goes through ast.literal_eval.
+    if (credential[:2] == "('" and credential[-2:] == "')" or credential[:2] == "['" and credential[-2:] == "']") and '\\' not in credential:
+        fields = credential[2:-2].split("', '")
+        if len(fields) == 2:
+            return fields[0], fields[1]
+    username, password = ast.literal_eval(credential)
+    return username, password
+
+def split_line_ranges(file_path, parts):
+    # Split a file into at most `parts` byte ranges (start, end) of similar size that begin and end
+    # on line boundaries, so each range can be read and parsed independently.
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return []
+    bounds = [0]
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for k in range(1, parts):
+            pos = mm.find(b'\n', max(size * k // parts, bounds[-1]) - 1)
+            end = size if pos == -1 else pos + 1
+            if end > bounds[-1]:
+                bounds.append(end)
+    if bounds[-1] < size:
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def block_count(file_path, min_blocks=1):
+    # Number of line-aligned ranges to split a file into for split_line_ranges: blocks of about 8MB,
+    # and at least min_blocks (e.g. a few per worker process).
+    return max(min_blocks, os.path.getsize(file_path) >> 23, 1)
+
+def read_line_range(file_path, start, end, decode=True):
+    # The lines in a byte range from split_line_ranges, without their line endings, which are translated
+    # as text mode would ('\r\n' and '\r' end a line too). With decode=False they are kept as bytes.
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    lines = data.decode('utf-8').split('\n') if decode else data.split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+def build_postings(rows, desc=None):
+    # Intern the tokens of rows to integer ids and return the inverted index in CSR form:
+    # the ids of the rows containing token t are postings[offsets[t]:offsets[t+1]].
+    token_ids = {}
+    tokens = []
+    row_ids = []
+    for i, row in tqdm(enumerate(rows), total=len(rows), desc=desc, mininterval=5):
+        for token in set(row):
+            tokens.append(token_ids.setdefault(token, len(token_ids)))
+            row_ids.append(i)
+    tokens = np.array(tokens, dtype=np.int32)
+    postings = np.array(row_ids, dtype=np.int32)[np.argsort(tokens, kind='stable')]
+    offsets = np.zeros(len(token_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(tokens, minlength=len(token_ids)), out=offsets[1:])
+    return token_ids, offsets, postings
+
+def build_id_postings(values, row_offsets, num_tokens):
+    # Same inverted index as build_postings for CSR rows whose tokens are already interned ids in
+    # [0, num_tokens), built without a Python loop; token t is its own id, so only (offsets, postings)
+    # are returned.
+    num_rows = len(row_offsets) - 1
+    row_ids = np.repeat(np.arange(num_rows, dtype=np.int64), np.diff(row_offsets))
+    # Sorting (token, row) keys drops duplicate tokens within a row and orders postings by row.
+    keys = np.unique(np.asarray(values, dtype=np.int64) * max(num_rows, 1) + row_ids)
+    tokens, rows = np.divmod(keys, max(num_rows, 1))
+    offsets = np.zeros(num_tokens + 1, dtype=np.int64)
+    np.cumsum(np.bincount(tokens, minlength=num_tokens), out=offsets[1:])
+    return offsets, rows.astype(np.int32)
+
+def gather_postings(index, tokens):
+    # Concatenated postings of the distinct indexed tokens, or None if none of them is indexed.
+    # Duplicates are dropped on the interned ids, so callers can pass raw token lists.
+    token_ids, offsets, postings = index
+    ids = {token_ids[t] for t in tokens if t in token_ids}
+    if not ids:
+        return None
+    return np.concatenate([postings[offsets[t]:offsets[t + 1]] for t in ids])
+
+def most_common_row(hits):
+    # Most frequent row id in hits and its count, lowest id on ties. Dense id ranges are counted
+    # with bincount; sparse ones with a sort-based unique to avoid a huge counts array.
+    low = int(hits.min())
+    span = int(hits.max()) - low + 1
+    if span <= 8 * len(hits):
+        counts = np.bincount(hits - low)
+        best = int(counts.argmax())
+        return best + low, int(counts[best])
+    rows, counts = np.unique(hits, return_counts=True)
+    best = counts.argmax()
+    return int(rows[best]), int(counts[best])
+
+def plaintext_sidecar_path(file_path):
+    # Binary sidecar of a plaintext query file: the same (user, freq, prefix_list, content_list)
+    # records as consecutive pickles.
+    return file_path + '.pkl'
+
+def iter_plaintext_records(file_path, legacy=False):
+    # Records of a plaintext query file, read from its pickle sidecar when there is one; with
+    # legacy=True (or no sidecar) the text lines are parsed with ast.literal_eval.
+    sidecar = plaintext_sidecar_path(file_path)
+    if not legacy and os.path.exists(sidecar):
+        with open(sidecar, 'rb') as infile:
+            while True:
+                try:
+                    yield pickle.load(infile)
+                except EOFError:
+                    return
+    else:
+        with open(file_path, 'r', encoding='utf-8') as infile:
+            for line in infile:
+                yield ast.literal_eval(line)
+
+def load_plaintext_series(file_path, windows_low, windows_high, min_count, legacy=False):
     data_series = []
     total = 0
-    with open(file_path, 'r', encoding='utf-8') as infile:
-        for line in tqdm(infile, desc='Loading plaintext series...'):
-            pos, times, hash_list, plaintext_list = eval(line)
-            if windows_low <= len(hash_list) <= windows_high and times >= min_count:
-                total += 1
-                data_series.append(hash_list)
+    for pos, times, hash_list, plaintext_list in tqdm(iter_plaintext_records(file_path, legacy), desc='Loading plaintext series...'):
+        if windows_low <= len(hash_list) <= windows_high and times >= min_count:
+            total += 1
+            data_series.append(hash_list)
     return data_series, total
 
-def load_leaked_dataset(leaked_dataset_path, query_type):
+def leaked_key(digest):
+    # 64-bit set key of a plaintext, taken from the first 8 bytes of its SHA-256 digest.
+    return int.from_bytes(digest[:8], 'little')
+
+def _load_leaked_range(task):
+    # Leaked-set entries of the lines in a byte range of a leaked dataset file.
+    file_path, start, end, query_type, hashed, parsed = task
+    lines = read_line_range(file_path, start, end)
+    sha256 = hashlib.sha256
+    if query_type == 'pass':
+        # Rows with fewer than 10 credentials are skipped before they are split or parsed.
+        texts = (parse_credential(c)[1] for line in lines if line.count('\t') >= 10 for c in line.split('\t')[:-1])
+    elif parsed and not hashed:
+        return set(parse_credential(c) for line in lines for c in line.split('\t')[:-1])
+    else:
+        texts = (str(parse_credential(c)) for line in lines for c in line.split('\t')[:-1])
+    if hashed:
+        return set(leaked_key(sha256(text.encode()).digest()) for text in texts)
+    return set(texts)
+
+def load_leaked_dataset(leaked_dataset_path, query_type, hashed=False, workers=1, parsed=False):
+    # With hashed=True the set holds leaked_key(sha256(text)) ints instead of the texts, where text is
+    # the password for 'pass' and the credential's string form for 'user' and 'cred'. Otherwise, with
+    # parsed=True, 'user' and 'cred' entries are (username, password) tuples instead of their string form.
+    # The file is read in line-aligned blocks (block_count), parsed in worker processes when workers > 1.
+    if query_type not in ('user', 'pass', 'cred'):
+        raise ValueError(f'Unsupported query type: {query_type}')
+    parts = block_count(leaked_dataset_path, workers * 4)
+    tasks = [(leaked_dataset_path, start, end, query_type, hashed, parsed) for start, end in split_line_ranges(leaked_dataset_path, parts)]
     leaked_set = set() # simulate the leaked dataset
-    with open(leaked_dataset_path, 'r') as leak_file:
-        if query_type == 'user':
-            for line in tqdm(leak_file, desc='load leaked dataset'):
-                credentials = line.split('\t')[:-1]
-                for c in credentials:
-                    credential = eval(c)
-                    leaked_set.add(str(credential))
-        elif query_type == 'pass':
-            for line in tqdm(leak_file, desc='load leaked dataset'):
-                credentials = line.split('\t')[:-1]
-                if len(credentials) < 10:
-                    continue
-                for c in credentials:
-                    credential = eval(c)
-                    username, password = credential
-                    leaked_set.add(password)
-        elif query_type == 'cred':
-            for line in tqdm(leak_file, desc='load leaked dataset'):
-                credentials = line.split('\t')[:-1]
-                for c in credentials:
-                    credential = eval(c)
-                    leaked_set.add(str(credential))
-        else:
-            raise ValueError(f'Unsupported query type: {query_type}')
-    return leaked_set
\ No newline at end of file
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        blocks = executor.map(_load_leaked_range, tasks) if executor else map(_load_leaked_range, tasks)
+        for entries in tqdm(blocks, total=len(tasks), desc='load leaked dataset'):
+            leaked_set |= entries
+    finally:
+        if executor:
+            executor.shutdown()
+    return leaked_set